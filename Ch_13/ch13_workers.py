@@ -0,0 +1,72 @@
+"""
+Chapter 13. worker fns for the process pools in ch_13.py
+
+they live in their own module so a spawned (or forkserver) worker can import them by name,
+fns defined in ch_13.py itself can't be found in a worker when the chapter is run cell by cell
+"""
+
+import csv
+import io
+import json
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+
+# 13.1 bitly: parse one newline-aligned byte range of the feed, only send back arrays for the fields we use
+
+def parse_bitly_shard(path, start, end):
+    tz, a, t, c, lat, lon = [], [], [], [], [], []
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            rec = json.loads(line)
+            tz.append(rec.get("tz", np.nan))
+            a.append(rec.get("a", np.nan))
+            t.append(rec.get("t", np.nan))
+            c.append(rec.get("c", np.nan))
+            ll = rec.get("ll") or (np.nan, np.nan)
+            lat.append(ll[0])
+            lon.append(ll[1])
+    return {"tz": np.array(tz, dtype=object), "a": np.array(a, dtype=object),
+            "t": np.array(t, dtype="float64"), "c": np.array(c, dtype=object),
+            "lat": np.array(lat, dtype="float64"), "lon": np.array(lon, dtype="float64")}
+
+# count one field over a shard, only the counter goes back (one entry per distinct value)
+
+def count_bitly_shard(path, start, end, field="tz"):
+    counts = Counter()
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            rec = json.loads(line)
+            if field in rec:
+                counts[rec[field]] += 1
+    return counts
+
+# 13.2 MovieLens: swap "::" for a one-byte separator and run the shard through the C parser
+
+def parse_dat_shard(path, start, end, schema, encoding=None):
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start).replace(b"::", b"\x1f")
+    frame = pd.read_csv(io.BytesIO(data), sep="\x1f", header=None, names=list(schema),
+                        dtype=schema, encoding=encoding, quoting=csv.QUOTE_NONE)
+    return {col: frame[col].to_numpy() for col in schema}
+
+# 13.3 babynames: one yobXXXX.txt file
+
+def read_year_file(path):
+    frame = pd.read_csv(path, names=["name", "sex", "births"])
+    return frame["name"].to_numpy(dtype=object), frame["sex"].to_numpy(dtype=object), frame["births"].to_numpy()
@@ -100,6 +100,128 @@ counts = Counter(time_zones)
 
 counts.most_common(10)  # notice the empty string with 521 observations
 
+# get_counts + top_counts sort the whole dict just to get the top 10.
+# ex: a counter that can be updated, merged across shards/processes, and gives the
+# top k w/ a bounded heap (heapq.nlargest is O(n log k) instead of a full sort)
+
+import heapq
+from operator import itemgetter
+
+class TopCounter:
+    def __init__(self, iterable=None):
+        self.counts = Counter()
+        if iterable is not None:
+            self.update(iterable)
+
+    def update(self, iterable):
+        self.counts.update(iterable)
+        return self
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        return self
+
+    def most_common(self, k=10):
+        return heapq.nlargest(k, self.counts.items(), key=itemgetter(1))
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def __len__(self):
+        return len(self.counts)
+
+tz_counter = TopCounter(time_zones)
+
+tz_counter.most_common(10)      # same as counts.most_common(10)
+
+tz_counter["America/New_York"]
+
+# exact counts need one dict entry per distinct value, and the user agent field ("a")
+# has an endless number of them. ex: an approximate top k w/ a fixed memory budget
+# using the Space-Saving algorithm. it only ever keeps `capacity` counters; a new value
+# takes over the smallest counter and inherits its count as the possible overcount (error)
+
+class SpaceSaving:
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.n = 0          # total number of values seen
+        self.counts = {}
+        self.errors = {}
+        self.heap = []      # one (count, seq, key) entry per key, the count may be stale (too low)
+        self.seq = 0
+
+    def _push(self, key):
+        self.seq += 1
+        heapq.heappush(self.heap, (self.counts[key], self.seq, key))
+
+    def _pop_min(self):
+        while True:
+            count, _, key = heapq.heappop(self.heap)
+            if self.counts[key] == count:
+                return key
+            self._push(key)     # count went up since it was pushed, put it back
+
+    def update(self, iterable):
+        counts, errors = self.counts, self.errors
+        for x in iterable:
+            self.n += 1
+            if x in counts:
+                counts[x] += 1
+            elif len(counts) < self.capacity:
+                counts[x] = 1
+                errors[x] = 0
+                self._push(x)
+            else:
+                old = self._pop_min()
+                low = counts.pop(old)
+                del errors[old]
+                counts[x] = low + 1
+                errors[x] = low
+                self._push(x)
+        return self
+
+    def min_count(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    # merging two summaries: a key missing from one side could have had at most
+    # that side's smallest count, so add that in as count and error, then keep the top `capacity`
+    def merge(self, other):
+        m1, m2 = self.min_count(), other.min_count()
+        keys = set(self.counts) | set(other.counts)
+        counts = {k: self.counts.get(k, m1) + other.counts.get(k, m2) for k in keys}
+        errors = {k: self.errors.get(k, m1) + other.errors.get(k, m2) for k in keys}
+        keep = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = {k: counts[k] for k in keep}
+        self.errors = {k: errors[k] for k in keep}
+        self.n += other.n
+        self.heap = []
+        for k in keep:
+            self._push(k)
+        return self
+
+    # no count is ever off by more than this
+    def error_bound(self):
+        return self.n / self.capacity
+
+    def most_common(self, k=10):
+        top = heapq.nlargest(k, self.counts, key=self.counts.get)
+        return pd.DataFrame({"count": [self.counts[x] for x in top],
+                             "error": [self.errors[x] for x in top]}, index=top)
+
+agents = SpaceSaving(capacity=200)
+
+agents.update(rec["a"] for rec in records if "a" in rec)
+
+agents.most_common(10)  # true count is between count - error and count
+
+agents.error_bound()
+
+tz_approx = SpaceSaving(capacity=50).update(time_zones)
+
+tz_approx.most_common(10)   # close to tz_counter.most_common(10)
+
 # Counting Time Zones with pandas
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -171,6 +293,50 @@ cframe["os"] = np.where(cframe["a"].str.contains("Windows"),
 
 cframe["os"].head(5)
 
+# str.contains rescans every agent string, but a few distinct agents cover most rows.
+# ex: factorize the column, classify each distinct agent once and broadcast the labels
+# back through the integer codes. the lru_cache keeps the answers around for the next batch/chunk
+
+from functools import lru_cache
+
+# first match wins, so the more specific tokens go first (Android agents also say Linux,
+# iPhone agents also say Mac OS X, Chrome agents also say Safari)
+os_rules = (("Windows", "Windows"), ("iPhone", "iOS"), ("iPad", "iOS"), ("iPod", "iOS"),
+            ("Android", "Android"), ("Mac OS X", "Mac"), ("Macintosh", "Mac"),
+            ("Linux", "Linux"), ("X11", "Linux"))
+
+browser_rules = (("MSIE", "IE"), ("Trident", "IE"), ("Chrome", "Chrome"), ("Firefox", "Firefox"),
+                 ("Opera", "Opera"), ("Safari", "Safari"))
+
+@lru_cache(maxsize=100_000)
+def classify_agent(agent, rules=os_rules, default="Other"):
+    for token, label in rules:
+        if token in agent:
+            return label
+    return default
+
+def classify_agents(agents, rules=os_rules, default="Other"):
+    codes, uniques = pd.factorize(agents)
+    labels = [classify_agent(agent, rules, default) for agent in uniques]
+    labels = np.array(labels + [np.nan], dtype=object)    # code -1 (missing agent) picks the NaN
+    return pd.Series(labels[codes], index=agents.index)
+
+# the same two buckets as the np.where version
+
+cframe["os"] = classify_agents(cframe["a"], rules=(("Windows", "Windows"),), default="Not Windows")
+
+cframe["os"].head(5)
+
+# but now we can have more than two
+
+cframe["os_family"] = classify_agents(cframe["a"], os_rules)
+
+cframe["browser"] = classify_agents(cframe["a"], browser_rules)
+
+cframe[["os_family", "browser"]].value_counts().head(10)
+
+classify_agent.cache_info()     # hits pile up across chunks since the cache outlives each call
+
 # now group the data by its time zone col and this new list of operating systems
 
 by_tz_os = cframe.groupby(["tz", "os"])
@@ -231,6 +397,206 @@ g = count_subset.groupby("tz")
 
 results2 = count_subset["total"] / g["total"].transform("sum")
 
+# Streaming the bitly feed in chunks
+
+# records + frame keeps the whole feed in memory twice (list of dicts, then the df).
+# ex: a generator that reads the file in fixed-size batches of lines and yields
+# each batch as a typed df chunk, so peak memory is bounded by chunksize
+
+from itertools import islice
+
+bitly_dtypes = {"a": object, "c": object, "nk": "float64", "tz": object,
+                "gr": object, "g": object, "h": object, "l": object,
+                "al": object, "hh": object, "r": object, "u": object,
+                "t": "float64", "hc": "float64", "cy": object, "ll": object}
+
+def read_bitly_chunks(path, chunksize=50_000, dtypes=bitly_dtypes):
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, chunksize))
+            if not lines:
+                break
+            batch = [json.loads(line) for line in lines]
+            # build column by column, missing keys become NaN like pd.DataFrame(records)
+            columns = {col: [rec.get(col, np.nan) for rec in batch] for col in dtypes}
+            yield pd.DataFrame(columns).astype(dtypes)
+
+# the tz counts now only need one chunk in memory at a time
+
+tz_counts = pd.Series(dtype="int64")
+
+for chunk in read_bitly_chunks(path):
+    clean_tz = chunk["tz"].fillna("Missing")
+    clean_tz[clean_tz == ""] = "Unknown"
+    tz_counts = tz_counts.add(clean_tz.value_counts(), fill_value=0)
+
+tz_counts = tz_counts.astype("int64")     # add w/ fill_value goes through float64
+
+tz_counts.sort_values(ascending=False).head()   # same as the tz_counts above
+
+# same idea for the tz/os table: keep only the (small) group sizes of each chunk,
+# then add them up and unstack once at the end
+
+pieces = []
+for chunk in read_bitly_chunks(path):
+    chunk = chunk[chunk["a"].notna()]
+    chunk_os = classify_agents(chunk["a"], rules=(("Windows", "Windows"),), default="Not Windows")
+    pieces.append(chunk.groupby([chunk["tz"], chunk_os.rename("os")]).size())
+
+agg_counts_streamed = pd.concat(pieces).groupby(level=["tz", "os"]).sum().unstack().fillna(0)
+
+agg_counts_streamed.head()  # matches agg_counts
+
+# Parsing the feed on multiple cores
+
+# json.loads is the slow part and it only runs on one core.
+# ex: split the file into byte ranges that start and end on a newline, parse each
+# range in a worker process and only send back arrays for the fields we use
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+def newline_shard_bounds(path, n_shards):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards, bounds[-1]))
+            f.readline()    # move to the start of the next full line
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+# the worker fns (parse_bitly_shard here, count_bitly_shard, parse_dat_shard and read_year_file
+# further down) live in ch13_workers.py. on mac/windows, and on linux from python 3.14 on, workers
+# are spawned (or forked from a server) instead of forked from this process, so they can only
+# run fns they can import by name, and they re-run this script (as __mp_main__) to set up __main__
+# first. so the pool only ever starts from under if __name__ == "__main__": (or when run cell by
+# cell), the loaders further down are called w/ workers=1 at module level. in_worker() is already
+# true during that re-run: pool_size won't start a pool there and the loaders don't write their
+# cache files, the main process does that
+
+import multiprocessing as mp
+
+from ch13_workers import parse_bitly_shard, count_bitly_shard, parse_dat_shard, read_year_file
+
+def in_worker():
+    return mp.current_process().name != "MainProcess"     # set before the worker re-runs the script
+
+def pool_size(workers=None):
+    return 1 if in_worker() else workers or os.cpu_count()
+
+# ordered=True puts the shards back in file order, ordered=False takes them as soon as
+# each worker is done (faster when you only need counts)
+
+def read_bitly_parallel(path, workers=None, shards_per_worker=4, ordered=True):
+    workers = pool_size(workers)
+    bounds = newline_shard_bounds(path, workers * shards_per_worker)
+    if workers == 1:
+        parts = [parse_bitly_shard(path, start, end) for start, end in bounds]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(parse_bitly_shard, path, start, end) for start, end in bounds]
+            done = futures if ordered else as_completed(futures)
+            parts = [fut.result() for fut in done]
+    columns = {col: np.concatenate([part[col] for part in parts]) for col in parts[0]}
+    return pd.DataFrame(columns)
+
+if __name__ == "__main__":
+    fast_frame = read_bitly_parallel(path)
+    print(fast_frame["tz"].value_counts().head())
+
+# benchmark vs the list comprehension path from the top of the section
+
+import time
+
+def time_it(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+def read_bitly_serial(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    return pd.DataFrame(records)[["tz", "a", "t", "c", "ll"]]
+
+if __name__ == "__main__":
+    serial_time = time_it(read_bitly_serial, path)
+    bench = pd.DataFrame({"workers": [1, 2, 4, 8]})
+    bench["ordered"] = [time_it(read_bitly_parallel, path, workers=w) for w in bench["workers"]]
+    bench["unordered"] = [time_it(read_bitly_parallel, path, workers=w, ordered=False) for w in bench["workers"]]
+    bench["speedup"] = serial_time / bench["ordered"]
+    print(bench)    # example.txt is tiny, the speedup only shows on the big daily files
+
+# the TopCounter from above fits here too: each worker counts its own shard
+# and only sends back a plain Counter (one entry per distinct value, not the raw records)
+
+if __name__ == "__main__":
+    with ProcessPoolExecutor() as pool:
+        futures = [pool.submit(count_bitly_shard, path, start, end)
+                   for start, end in newline_shard_bounds(path, os.cpu_count())]
+        shard_counter = TopCounter()
+        for fut in as_completed(futures):
+            shard_counter.update(fut.result())     # Counter.update adds the counts
+    print(shard_counter.most_common(10))    # same as tz_counter.most_common(10)
+
+# Normalizing within groups w/o apply
+
+# groupby("tz").apply(norm_total) calls a python fn once per group. transform is faster,
+# but we can go one step further: one pass to get the group totals (bincount on the group
+# codes) and one divide, for any set of keys
+
+# group_codes turns one or more key columns into one int code per row (0..n_groups-1).
+# w/ sort=True the codes follow the sorted order of the keys, same as groupby's group order
+
+def group_codes(df, keys, sort=False):
+    if isinstance(keys, str):
+        keys = [keys]
+    codes = np.zeros(len(df), dtype="int64")
+    for key in keys:
+        key_codes, uniques = pd.factorize(df[key], sort=sort, use_na_sentinel=False)
+        codes = codes * len(uniques) + key_codes
+    if len(keys) > 1:
+        codes = pd.factorize(codes, sort=sort)[0]
+    return codes
+
+def normalize_within(df, keys, column):
+    codes = group_codes(df, keys)
+    values = df[column].to_numpy(dtype="float64", copy=True)
+    weights = np.where(np.isnan(values), 0, values) if np.isnan(values).any() else values
+    totals = np.bincount(codes, weights=weights)
+    np.divide(values, totals[codes], out=values)     # divide in place, no extra array
+    return pd.Series(values, index=df.index, name=column)
+
+count_subset["normed_total"] = normalize_within(count_subset, "tz", "total")
+
+count_subset.head()     # same numbers as results / results2
+
+# benchmark: apply vs transform vs normalize_within on fake tz/os totals, within tz and within tz/os
+# (the 10**8 row frame needs a few GB of RAM, so it only runs w/ run_big=True)
+
+def bench_normalize(n, keys="tz", n_groups=1000):
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    rng = np.random.default_rng(12345)
+    df = pd.DataFrame({"tz": rng.integers(0, n_groups, n),
+                       "os": rng.integers(0, 2, n),
+                       "total": rng.random(n)})
+    return {"keys": "/".join(keys), "rows": n,
+            "apply": time_it(lambda: df.groupby(keys).apply(norm_total)),
+            "transform": time_it(lambda: df["total"] / df.groupby(keys)["total"].transform("sum")),
+            "normalize_within": time_it(normalize_within, df, keys, "total")}
+
+def normalize_bench(run_big=False):
+    sizes = [10**6, 10**7] + ([10**8] if run_big else [])
+    bench = pd.DataFrame([bench_normalize(n, keys) for keys in ["tz", ["tz", "os"]] for n in sizes])
+    bench = bench.set_index(["keys", "rows"])
+    bench["speedup vs apply"] = bench["apply"] / bench["normalize_within"]
+    return bench
+
+if __name__ == "__main__":
+    norm_bench = normalize_bench()
+    print(norm_bench)
+
 # 13.2 MovieLens 1M Dataset
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -247,6 +613,41 @@ mnames = ["movies_id", "title", "genres"]
 movies = pd.read_table("../book files/datasets/movielens/movies.dat", sep="::",
                         header=None, names=mnames, engine="python")
 
+# sep="::" is more than one char, so read_table has to use the slow python engine.
+# ex: a dedicated reader for "::" files. each newline-aligned shard of the file swaps "::" for a
+# one-byte separator (\x1f never shows up in the text) and goes through the fast C parser
+# straight into the typed columns of the schema (parse_dat_shard in ch13_workers.py). shards run on
+# the process pool like the bitly feed
+
+user_schema = {"user_id": np.int32, "gender": object, "age": np.int8,
+               "occupation": np.int8, "zip": object}
+
+rating_schema = {"user_id": np.int32, "movie_id": np.int32, "rating": np.int8,
+                 "timestamp": np.int64}
+
+movie_schema = {"movies_id": np.int32, "title": object, "genres": object}
+
+def read_dat(path, schema, workers=None, shards_per_worker=2, encoding=None):
+    workers = pool_size(workers)
+    bounds = newline_shard_bounds(path, workers * shards_per_worker)
+    if workers == 1 or len(bounds) == 1:
+        parts = [parse_dat_shard(path, start, end, schema, encoding) for start, end in bounds]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(parse_dat_shard, path, start, end, schema, encoding)
+                       for start, end in bounds]
+            parts = [fut.result() for fut in futures]
+    columns = {col: np.concatenate([part[col] for part in parts]) for col in schema}
+    return pd.DataFrame(columns)
+
+users = read_dat("../book files/datasets/movielens/users.dat", user_schema, workers=1)
+
+ratings = read_dat("../book files/datasets/movielens/ratings.dat", rating_schema, workers=1)  # workers=None: on the pool
+
+movies = read_dat("../book files/datasets/movielens/movies.dat", movie_schema, workers=1)
+
+ratings.info()  # int32 ids, int8 ratings: ~10 bytes a row instead of 32
+
 # you can verify that everything succeeded by looking at each df
 
 users.head(5)
@@ -269,6 +670,72 @@ data.head()     # this should work for the most part
 
 data.iloc[0]
 
+# Caching the merged table
+
+# every run re-parses the 3 .dat files and redoes both merges.
+# ex: save the merged table once as one .npy file per column + a manifest.json, and on the next
+# run open the columns w/ np.load(mmap_mode="r") so nothing gets copied into RAM.
+# string cols are stored as categorical codes + categories so they can be memory-mapped too.
+# the manifest records the size and mtime of each source file; if either changes the cache is rebuilt
+
+def source_stamp(paths):
+    return {os.path.basename(p): [os.path.getsize(p), os.stat(p).st_mtime_ns] for p in paths}
+
+def save_column_cache(frame, cache_dir, sources):
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = {"sources": source_stamp(sources), "rows": len(frame), "columns": {}}
+    for i, col in enumerate(frame.columns):
+        values = frame[col]
+        if pd.api.types.is_numeric_dtype(values) and not isinstance(values.dtype, pd.CategoricalDtype):
+            np.save(os.path.join(cache_dir, f"{i}.npy"), values.to_numpy())
+            manifest["columns"][col] = {"file": i, "kind": "values"}
+        else:
+            cat = values.astype("category").array
+            np.save(os.path.join(cache_dir, f"{i}.codes.npy"), cat.codes)
+            np.save(os.path.join(cache_dir, f"{i}.categories.npy"), np.asarray(cat.categories, dtype=str))
+            manifest["columns"][col] = {"file": i, "kind": "categorical"}
+    # manifest goes last, so a half written cache never looks valid
+    with open(os.path.join(cache_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+def load_column_cache(cache_dir, sources):
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest["sources"] != source_stamp(sources):
+        return None     # stale
+    columns = {}
+    for col, spec in manifest["columns"].items():
+        base = os.path.join(cache_dir, str(spec["file"]))
+        if spec["kind"] == "values":
+            columns[col] = np.load(base + ".npy", mmap_mode="r")
+        else:
+            codes = np.load(base + ".codes.npy", mmap_mode="r")
+            categories = np.load(base + ".categories.npy")
+            columns[col] = pd.Categorical.from_codes(codes, categories, validate=False)
+    return pd.DataFrame(columns, copy=False)
+
+def load_movielens(data_dir="../book files/datasets/movielens", cache_dir=None, workers=None):
+    cache_dir = cache_dir or os.path.join(data_dir, "merged_cache")
+    sources = [os.path.join(data_dir, name) for name in ["users.dat", "ratings.dat", "movies.dat"]]
+    data = load_column_cache(cache_dir, sources)
+    if data is None:
+        users = read_dat(sources[0], user_schema, workers=1)
+        ratings = read_dat(sources[1], rating_schema, workers=workers)
+        movies = read_dat(sources[2], movie_schema, workers=1)
+        merged = ratings.merge(users, on="user_id").merge(movies, left_on="movie_id", right_on="movies_id")
+        if in_worker():
+            return merged
+        save_column_cache(merged, cache_dir, sources)
+        data = load_column_cache(cache_dir, sources)
+    return data
+
+data = load_movielens(workers=1)    # first run builds the cache, later runs just map the files
+
+data.iloc[0]
+
 # ex: to get mean movie rating by gender, use pivot_table
 
 mean_ratings = data.pivot_table("rating", index="title", columns="gender", aggfunc="mean")
@@ -333,6 +800,140 @@ rating_std_by_title.head()
 
 rating_std_by_title.sort_values(ascending=False)[:10]
 
+# Sparse user x movie ratings
+
+# a dense user x title pivot is ~99% empty (each user only rates a few movies).
+# ex: build a CSR matrix from the integer codes of user and title instead. rows are users,
+# cols are titles, and only the ratings that exist are stored
+
+from scipy import sparse
+
+def build_rating_matrix(data, row="user_id", col="title", value="rating"):
+    row_codes, row_labels = pd.factorize(data[row], sort=True)
+    col_codes, col_labels = pd.factorize(data[col], sort=True)
+    matrix = sparse.csr_matrix((data[value].to_numpy(dtype="float64"), (row_codes, col_codes)),
+                               shape=(len(row_labels), len(col_labels)))
+    if matrix.nnz != len(data):
+        raise ValueError(f"more than one {value} for some ({row}, {col}) pairs")   # csr would add them up
+    return matrix, pd.Index(row_labels, name=row), pd.Index(col_labels, name=col)
+
+# count, mean and std for every row (axis=1) or every col (axis=0), only touching the stored ratings
+
+def sparse_stats(matrix, labels, axis=0):
+    m = matrix.tocsr() if axis == 1 else matrix.tocsc()
+    count = np.diff(m.indptr)
+    owner = np.repeat(np.arange(len(count)), count)     # which row/col each stored rating belongs to
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(owner, weights=m.data, minlength=len(count)) / count
+        dev = m.data - mean[owner]
+        std = np.sqrt(np.bincount(owner, weights=dev ** 2, minlength=len(count)) / (count - 1))
+    return pd.DataFrame({"count": count, "mean": mean, "std": std}, index=labels)
+
+# pull a slice back out as a df, either long (one row per rating) or dense w/ NaN for "not rated"
+
+def label_positions(labels, wanted=None):
+    if wanted is None:
+        return np.arange(len(labels))
+    pos = labels.get_indexer(wanted)
+    if (pos < 0).any():     # -1 would quietly pick the last row/col
+        raise KeyError(f"not in {labels.name}: {list(pd.Index(wanted)[pos < 0])}")
+    return pos
+
+def rating_frame(matrix, row_labels, col_labels, rows=None, cols=None, dense=False):
+    row_pos = label_positions(row_labels, rows)
+    col_pos = label_positions(col_labels, cols)
+    sub = matrix[row_pos][:, col_pos].tocoo()
+    if dense:
+        values = np.full(sub.shape, np.nan)
+        values[sub.row, sub.col] = sub.data
+        return pd.DataFrame(values, index=row_labels[row_pos], columns=col_labels[col_pos])
+    return pd.DataFrame({row_labels.name: row_labels[row_pos][sub.row],
+                         col_labels.name: col_labels[col_pos][sub.col],
+                         "rating": sub.data})
+
+rating_matrix, user_index, title_index = build_rating_matrix(data)
+
+rating_matrix   # ~6k users x ~3.7k titles, but only 1M stored values
+
+title_stats = sparse_stats(rating_matrix, title_index, axis=0)
+
+title_stats.loc[active_titles, "std"].sort_values(ascending=False)[:10]    # same as rating_std_by_title
+
+user_stats = sparse_stats(rating_matrix, user_index, axis=1)
+
+user_stats.head()
+
+rating_frame(rating_matrix, user_index, title_index, rows=user_index[:5], cols=active_titles[:5], dense=True)
+
+# Rating stats that can be updated
+
+# mean_ratings, ratings_by_title and rating_std_by_title all rescan the whole table.
+# ex: keep count, mean and M2 (sum of squared deviations) per key. a new batch of ratings is
+# summarized w/ one groupby and folded into the running state (Welford/Chan update), and two
+# partial states (e.g. from different workers) merge the same way, so history is never rescanned
+
+class RatingStats:
+    def __init__(self, keys, value="rating"):
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.value = value
+        self.state = None   # df indexed by the keys w/ count, mean, m2
+
+    def update(self, batch):
+        g = batch.groupby(self.keys, observed=True)[self.value]
+        part = pd.DataFrame({"count": g.count(), "mean": g.mean()})
+        part["m2"] = g.var(ddof=0) * part["count"]
+        return self._absorb(part)
+
+    def merge(self, other):
+        return self._absorb(other.state)
+
+    def _absorb(self, part):
+        if part is None or part.empty:     # other store never saw a batch / empty batch
+            return self
+        if self.state is None or self.state.empty:
+            self.state = part.copy()
+            return self
+        a, b = self.state.align(part, join="outer", fill_value=0)
+        n = a["count"] + b["count"]
+        delta = b["mean"] - a["mean"]
+        self.state = pd.DataFrame({"count": n,
+                                   "mean": a["mean"] + delta * b["count"] / n,
+                                   "m2": a["m2"] + b["m2"] + delta ** 2 * a["count"] * b["count"] / n})
+        return self
+
+    def count(self):
+        return self.state["count"]
+
+    def mean(self):
+        return self.state["mean"]
+
+    def std(self):
+        return np.sqrt(self.state["m2"] / (self.state["count"] - 1))
+
+    def active(self, min_count=250):
+        return self.state.index[self.state["count"] >= min_count]
+
+    def top_by_mean(self, n=10, min_count=250):
+        return self.mean().loc[self.active(min_count)].nlargest(n)
+
+    def top_by_std(self, n=10, min_count=250):
+        return self.std().loc[self.active(min_count)].nlargest(n)
+
+by_title = RatingStats("title")
+by_title_gender = RatingStats(["title", "gender"])
+
+# pretend the ratings come in 4 batches
+
+for batch in np.array_split(np.arange(len(data)), 4):
+    by_title.update(data.iloc[batch])
+    by_title_gender.update(data.iloc[batch])
+
+active_titles = by_title.active(250)    # same as ratings_by_title >= 250
+
+by_title_gender.mean().unstack("gender").loc[active_titles].sort_values("F", ascending=False)  # top_female_ratings
+
+by_title.top_by_std(10)     # same as rating_std_by_title.sort_values(ascending=False)[:10]
+
 # ex: movies can belong to multiple genres. to help us group by genre
 # use the explode method on df. first, we split the genres string into a list of genres
 # using str.split method on the series
@@ -367,6 +968,47 @@ genre_ratings = (ratings_with_genre.groupby(["genre", "age"])["rating"].mean().u
 
 genre_ratings[:10]
 
+# Genre stats w/o exploding the ratings
+
+# explode + merge copies every rating (and its strings) once per genre of the movie.
+# ex: split each movie's genres only once into (movie_id, genre_code) pairs. the ratings are first
+# summed per (movie, age) w/ bincount, and the sparse movie x genre 0/1 matrix then adds those
+# movie sums up into genre sums, so the exploded table never exists
+
+from itertools import chain
+
+def build_genre_index(movie_ids, genres):
+    lists = [g.split("|") if isinstance(g, str) else list(g) for g in genres]
+    counts = [len(g) for g in lists]
+    genre_codes, genre_names = pd.factorize(np.array(list(chain.from_iterable(lists)), dtype=object), sort=True)
+    pairs = pd.DataFrame({"movie_id": np.repeat(np.asarray(movie_ids), counts),
+                          "genre_code": genre_codes.astype(np.int16)})
+    return pairs, pd.Index(genre_names, name="genre")
+
+def genre_rating_means(genre_index, movie_ids, values, by):
+    pairs, genre_names = genre_index
+    movies_seen = pd.Index(pairs["movie_id"].unique())
+    movie_pos = movies_seen.get_indexer(movie_ids)
+    by_codes, by_labels = pd.factorize(by, sort=True)
+    keep = movie_pos >= 0
+    cell = movie_pos[keep] * len(by_labels) + by_codes[keep]
+    shape = (len(movies_seen), len(by_labels))
+    sums = np.bincount(cell, weights=np.asarray(values, dtype="float64")[keep], minlength=shape[0] * shape[1]).reshape(shape)
+    counts = np.bincount(cell, minlength=shape[0] * shape[1]).reshape(shape)
+    incidence = sparse.csr_matrix((np.ones(len(pairs)), (movies_seen.get_indexer(pairs["movie_id"]), pairs["genre_code"])),
+                                  shape=(len(movies_seen), len(genre_names)))
+    with np.errstate(invalid="ignore"):
+        means = (incidence.T @ sums) / (incidence.T @ counts)
+    return pd.DataFrame(means, index=genre_names, columns=pd.Index(by_labels, name=by.name))
+
+genre_index = build_genre_index(movies["movies_id"], movies["genre"])
+
+genre_index[0].head()
+
+genre_ratings = genre_rating_means(genre_index, data["movie_id"], data["rating"], data["age"])
+
+genre_ratings[:10]  # same table as the explode version
+
 # 13.3 US Baby Names 1880–2010
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -398,6 +1040,77 @@ names = pd.concat(pieces, ignore_index=True) # True because we're not interestee
 
 names
 
+# Loading all the years at once
+
+# 142 read_csv calls one after another, then concat copies everything again.
+# ex: a quick sizing pass counts the rows in each file, so we can allocate the final columns once.
+# the files are parsed on a process pool and each result is written straight into its slice
+# (the year column doesn't even need parsing, it's just each year repeated row-count times)
+
+def count_rows(path):
+    rows, last = 0, b"\n"
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            rows += block.count(b"\n")
+            last = block[-1:]
+    return rows + (last != b"\n")     # last line w/o a newline
+
+# the same ~100k name strings are repeated millions of times as python objects.
+# ex: a shared name dictionary (name -> int32 code) that grows as the files come in. the name col
+# is a categorical on top of it, and the dictionary is saved next to the data so the codes stay
+# the same from run to run (new names only ever get appended)
+
+def load_name_dictionary(path):
+    if not os.path.exists(path):
+        return pd.Index([], dtype=object)
+    with open(path) as f:
+        return pd.Index(f.read().splitlines(), dtype=object)
+
+def save_name_dictionary(dictionary, path):
+    with open(path, "w") as f:
+        f.writelines(name + "\n" for name in dictionary)
+
+def encode_names(values, dictionary):
+    codes = dictionary.get_indexer(values)
+    new = codes < 0
+    if new.any():
+        dictionary = dictionary.append(pd.Index(pd.unique(values[new]), dtype=object))
+        codes[new] = dictionary.get_indexer(values[new])
+    return codes.astype(np.int32), dictionary
+
+from contextlib import nullcontext
+
+def load_babynames(data_dir="../book files/datasets/babynames", years=range(1880, 2022), workers=None):
+    paths = [f"{data_dir}/yob{year}.txt" for year in years]
+    dict_path = os.path.join(data_dir, "name_dictionary.txt")
+    name_dict = load_name_dictionary(dict_path)
+    known = len(name_dict)
+    sizes = np.array([count_rows(p) for p in paths])
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    name = np.empty(offsets[-1], dtype=np.int32)
+    sex = np.empty(offsets[-1], dtype=object)
+    births = np.empty(offsets[-1], dtype=np.int64)
+    year = np.repeat(np.asarray(years, dtype=np.int64), sizes)
+    workers = pool_size(workers)
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as pool:
+        parts = map(read_year_file, paths) if pool is None else pool.map(read_year_file, paths)
+        # taken in file order (not as completed) so new names get the same codes every run
+        for i, (file_name, file_sex, file_births) in enumerate(parts):
+            lo, hi = offsets[i], offsets[i + 1]
+            if len(file_births) != hi - lo:
+                raise ValueError(f"{paths[i]}: expected {hi - lo} rows, got {len(file_births)}")
+            name[lo:hi], name_dict = encode_names(file_name, name_dict)
+            sex[lo:hi] = file_sex
+            births[lo:hi] = file_births
+    if len(name_dict) > known and not in_worker():
+        save_name_dictionary(name_dict, dict_path)
+    return pd.DataFrame({"name": pd.Categorical.from_codes(name, name_dict, validate=False),
+                         "sex": sex, "births": births, "year": year}, copy=False)
+
+names = load_babynames(workers=1)   # same table as the concat version, but name is a categorical
+
+names.memory_usage(deep=True)   # int32 codes + one copy of each name
+
 # Now, we can start aggregating the data at the year & sex level
 # using groupby or pivot_table
 
@@ -443,6 +1156,48 @@ top1000 = top1000.reset_index(drop=True)
 
 top1000.head()
 
+# Vectorized prop and top 1000
+
+# apply(add_prop) and apply(get_top1000) run a python fn (and a full sort) for every year/sex group.
+# ex: prop is just births over the group total, which normalize_within from the bitly section
+# already does in one pass
+
+names["prop"] = normalize_within(names, ["year", "sex"], "births")
+
+# ex: for the top n per group, one lexsort puts the rows in (group, -births) order. a row's rank is its
+# position minus the position where its group starts, and we keep ranks < n.
+# lexsort is stable, so tied births stay in file order.
+# ascending=True gives the n smallest instead, keep="all" also keeps rows tied w/ the last one kept
+# (like nlargest), and n can be a dict/Series of group key -> n (groups not in it are dropped).
+# NaN values are never picked
+
+def top_n_by_group(df, keys, column, n, ascending=False, keep="first"):
+    codes = group_codes(df, keys, sort=True)
+    values = df[column].to_numpy(dtype="float64")
+    order = np.lexsort((values if ascending else -values, codes))
+    sorted_codes = codes[order]
+    sorted_values = values[order]
+    starts = np.searchsorted(sorted_codes, sorted_codes)
+    rank = np.arange(len(order)) - starts
+    if np.ndim(n) == 0 and not isinstance(n, dict):
+        limit = n
+    else:
+        first_rows = df.iloc[order[np.unique(starts)]]
+        groups = pd.Index(first_rows[keys]) if isinstance(keys, str) else pd.MultiIndex.from_frame(first_rows[keys])
+        limit = pd.Series(n).reindex(groups).fillna(0).to_numpy(dtype=np.int64)[sorted_codes]
+    mask = rank < limit
+    if keep == "all":
+        # value of the last row kept in each group, anything equal to it stays too
+        last = np.maximum.reduceat(np.where(mask, np.arange(len(order)), -1), np.unique(starts))
+        cutoff = np.where(last >= 0, sorted_values[np.maximum(last, 0)], np.nan)
+        mask |= sorted_values == cutoff[sorted_codes]
+    mask &= ~np.isnan(sorted_values)
+    return df.iloc[order[mask]].reset_index(drop=True)
+
+top1000 = top_n_by_group(names, ["year", "sex"], "births", 1000)
+
+top1000.head()      # same rows as grouped.apply(get_top1000)
+
 # Analyzing Naming Trends
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -528,6 +1283,38 @@ diversity.head()
 
 diversity.plot(title="Number of popular names in top 50%")
 
+# ex: get_quantile_count re-sorts and re-cumsums every group on every call. instead, sort top1000
+# by (year, sex, -prop) once and keep the running prop within each group + where each group starts.
+# then one searchsorted answers every group and any q at once
+
+def build_cumprop_index(df, keys=["year", "sex"], column="prop"):
+    codes = group_codes(df, keys, sort=True)
+    values = df[column].to_numpy()
+    order = np.lexsort((-values, codes))
+    sorted_codes = codes[order]
+    cumprop = pd.Series(values[order]).groupby(sorted_codes).cumsum().to_numpy()
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    groups = pd.MultiIndex.from_frame(df[keys].iloc[order[starts]])
+    # complex numbers sort by real part, then imag part, so group + 1j * cumprop is
+    # one sorted array we can search for (group, q) pairs exactly
+    return {"key": sorted_codes + 1j * cumprop, "starts": starts, "groups": groups}
+
+def quantile_counts(index, q=0.5):
+    qs = np.atleast_1d(q)
+    group = np.arange(len(index["starts"]))
+    targets = (group[:, None] + 1j * qs[None, :]).ravel()
+    pos = np.searchsorted(index["key"], targets).reshape(len(group), len(qs))
+    counts = pos - index["starts"][:, None] + 1     # same +1 as get_quantile_count
+    return pd.DataFrame(counts, index=index["groups"], columns=pd.Index(qs, name="q"))
+
+cumprop_index = build_cumprop_index(top1000)
+
+diversity = quantile_counts(cumprop_index, 0.5)[0.5].unstack()     # same as the apply version
+
+diversity.head()
+
+quantile_counts(cumprop_index, [0.25, 0.5, 0.75, 0.9]).head()   # several q at once
+
 # The “last letter” revolution
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -579,6 +1366,64 @@ dny_ts.head()
 
 dny_ts.plot()
 
+# Last letter cube
+
+# get_last_letter runs once per row, and every view above is a fresh pivot over all of names.
+# ex: take the last letter once per distinct name (through the name dictionary, i.e. the categories),
+# then bincount the births into one dense letter x sex x year cube and save it. subtable, letter_prop
+# and dny_ts are then just slices of the cube
+
+def build_letter_cube(names, path=None):
+    name_cat = names["name"].astype("category").array     # no copy if it's already categorical
+    letter_of_name, letters = pd.factorize(pd.Index(name_cat.categories).str[-1], sort=True)
+    letter_codes = letter_of_name[name_cat.codes]
+    sex_codes, sexes = pd.factorize(names["sex"], sort=True)
+    year_codes, years = pd.factorize(names["year"], sort=True)
+    shape = (len(letters), len(sexes), len(years))
+    cell = (letter_codes * shape[1] + sex_codes) * shape[2] + year_codes
+    births = np.bincount(cell, weights=names["births"], minlength=np.prod(shape)).reshape(shape)
+    cube = {"births": births, "letters": np.asarray(letters, dtype=str),
+            "sexes": np.asarray(sexes, dtype=str), "years": np.asarray(years)}
+    if path is not None and not in_worker():
+        np.savez(path, **cube)
+    return cube
+
+def load_letter_cube(path):
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+# a slice of the cube as a df shaped like the pivot_table: letters down, (sex, year) across.
+# empty cells are NaN like in pivot_table
+
+def letter_table(cube, sexes=None, years=None):
+    sex_labels = cube["sexes"] if sexes is None else np.asarray(sexes)
+    year_labels = cube["years"] if years is None else np.asarray(years)
+    s = label_positions(pd.Index(cube["sexes"], name="sex"), sex_labels)
+    y = label_positions(pd.Index(cube["years"], name="year"), year_labels)
+    values = cube["births"][:, s][:, :, y].reshape(len(cube["letters"]), -1)
+    columns = pd.MultiIndex.from_product([sex_labels, year_labels], names=["sex", "year"])
+    index = pd.Index(cube["letters"], name="last_letter")
+    return pd.DataFrame(np.where(values > 0, values, np.nan), index=index, columns=columns)
+
+# share of a sex's births ending in each letter, as time series (one col per letter)
+
+def letter_share_ts(cube, letters, sex):
+    l = label_positions(pd.Index(cube["letters"], name="last_letter"), letters)
+    s = pd.Index(cube["sexes"]).get_loc(sex)
+    totals = cube["births"][:, s, :].sum(axis=0)
+    return pd.DataFrame((cube["births"][l, s, :] / totals).T,
+                        index=pd.Index(cube["years"], name="year"), columns=pd.Index(letters, name="last_letter"))
+
+letter_cube = build_letter_cube(names, "../book files/datasets/babynames/last_letter_cube.npz")
+
+subtable = letter_table(letter_cube, years=[1901, 1960, 2021])
+
+letter_prop = subtable / subtable.sum()     # same as before
+
+dny_ts = letter_share_ts(letter_cube, ["d", "n", "y"], "M")
+
+dny_ts.head()
+
 # Boy names that became girl names (and vice versa)
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -609,6 +1454,76 @@ table.tail()
 
 table.plot(style={"M": "k-", "F":"k--"})
 
+# Per-name lookups
+
+# each of the queries above (str.contains, isin, groupby, pivot_table) scans all of top1000.
+# ex: sort the rows once by (name code, year) and keep where each name's rows start (CSR style
+# offsets). one name's series is then a slice, and prefix/substring searches only look at the
+# list of distinct names, never at the rows
+
+class NameIndex:
+    def __init__(self, df):
+        name_cat = df["name"].astype("category").array
+        codes = name_cat.codes
+        order = np.lexsort((df["year"].to_numpy(), codes))
+        self.frame = df.iloc[order].reset_index(drop=True)
+        self.year = self.frame["year"].to_numpy()
+        self.births = self.frame["births"].to_numpy()
+        counts = np.bincount(codes, minlength=len(name_cat.categories))
+        self.offsets = np.r_[0, np.cumsum(counts)]
+        self.births_cumsum = np.r_[0, np.cumsum(self.births)]
+        present = np.flatnonzero(counts)      # names that have rows in df
+        self.names = pd.Index(name_cat.categories)[present]
+        self.codes = present
+        alpha = np.argsort(np.asarray(self.names, dtype=str))
+        self.sorted_names = np.asarray(self.names, dtype=str)[alpha]
+        self.sorted_codes = present[alpha]
+
+    def code(self, name):
+        return self.codes[self.names.get_loc(name)]
+
+    def prefix(self, text):
+        lo, hi = np.searchsorted(self.sorted_names, [text, text + "\uffff"])
+        return pd.Index(self.sorted_names[lo:hi])
+
+    def contains(self, text):
+        return self.names[self.names.str.contains(text)]
+
+    def series(self, name):
+        c = self.code(name)
+        lo, hi = self.offsets[c], self.offsets[c + 1]
+        year = self.year[lo:hi]
+        starts = np.flatnonzero(np.r_[True, year[1:] != year[:-1]])   # F and M rows of the same year
+        return pd.Series(np.add.reduceat(self.births[lo:hi], starts), index=pd.Index(year[starts], name="year"), name=name)
+
+    def _codes(self, names):
+        return np.array([self.code(name) for name in names], dtype=np.intp)  # stays an int array when empty
+
+    def totals(self, names):
+        c = self._codes(names)
+        return pd.Series(self.births_cumsum[self.offsets[c + 1]] - self.births_cumsum[self.offsets[c]],
+                         index=pd.Index(names, name="name"), name="births")
+
+    def rows(self, names):
+        c = self._codes(names)
+        lo, n = self.offsets[c], self.offsets[c + 1] - self.offsets[c]
+        take = np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum())    # the row ranges back to back
+        return self.frame.iloc[take]
+
+name_index = NameIndex(top1000)
+
+lesley_like = name_index.contains("Lesl")
+
+name_index.totals(lesley_like)      # same as filtered.groupby("name")["births"].sum()
+
+name_index.series("Leslie").tail()
+
+table = name_index.rows(lesley_like).pivot_table("births", index="year", columns="sex", aggfunc="sum")
+
+table = table.div(table.sum(axis="columns"), axis="index")
+
+name_index.prefix("Lesl")
+
 # 13.4 USDA Food Database
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -664,6 +1579,89 @@ nutrients = pd.concat(nutrients, ignore_index=True)
 
 nutrients
 
+# ex: the loop above makes ~6,600 little dfs just to concat them. instead, walk db once and append
+# to one growable buffer per column (typed arrays for the numbers, lists for the strings), then
+# build nutrients in one go. the info cols get filled in the same pass
+
+from array import array
+
+def flatten_usda(records, info_keys=info_keys, nutrient_keys=("units", "description", "group")):
+    info_cols = {key: [] for key in info_keys}
+    nut_cols = {key: [] for key in nutrient_keys}
+    values = array("d")
+    ids = array("q")
+    for rec in records:
+        for key in info_keys:
+            info_cols[key].append(rec.get(key, np.nan))
+        for nut in rec["nutrients"]:
+            value = nut.get("value")
+            values.append(np.nan if value is None else value)    # missing key or JSON null
+            for key in nutrient_keys:
+                nut_cols[key].append(nut.get(key, np.nan))
+        ids.extend([rec["id"]] * len(rec["nutrients"]))
+    # np.frombuffer wraps the typed arrays w/o copying them
+    nutrients = pd.DataFrame({"value": np.frombuffer(values, dtype=np.float64), **nut_cols,
+                              "id": np.frombuffer(ids, dtype=np.int64)}, copy=False)
+    return pd.DataFrame(info_cols), nutrients
+
+info, nutrients = flatten_usda(db)
+
+nutrients   # same table as the concat version
+
+# json.load has to build the whole document before we can touch the first food.
+# ex: a generator that yields one element of the top level array at a time, so memory only
+# has to hold one record (plus a read buffer). flatten_usda takes any iterable, so it can eat
+# the records as they come. uses ijson if it's installed, otherwise plain json.JSONDecoder.raw_decode
+# on a buffer that gets refilled from the file
+
+import re
+
+_json_gap = re.compile(r"[\s,]*")      # whitespace + the commas between elements
+
+def iter_json_array(path, chunk_size=1 << 16):
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+    if ijson is not None:
+        with open(path, "rb") as f:
+            yield from ijson.items(f, "item", use_float=True)
+        return
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf = f.read(chunk_size)
+        while buf.isspace():     # only whitespace so far, keep reading
+            more = f.read(chunk_size)
+            if not more:
+                break
+            buf += more
+        pos = len(buf) - len(buf.lstrip())
+        if buf[pos:pos + 1] != "[":
+            raise ValueError(f"{path} does not start w/ a JSON array")
+        pos += 1
+        while True:
+            pos = _json_gap.match(buf, pos).end()
+            if buf[pos:pos + 1] == "]":
+                return
+            error = None
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as exc:
+                error, end = exc, len(buf)
+            if end >= len(buf) or buf[end] not in " \t\r\n,]":
+                # the element may continue in the next chunk (a number like 2.5 cut at "2." parses
+                # as 2, hence the check for what comes after it). read at least as much as we
+                # already hold, so a big element isn't re-parsed over and over
+                more = f.read(max(chunk_size, len(buf) - pos))
+                if not more:
+                    raise error or ValueError(f"{path} ends before the array is closed")
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield item
+            pos = end
+
+info, nutrients = flatten_usda(iter_json_array("../book files/datasets/usda_food/database.json"))
+
 # there are some duplicates, so drop them
 
 nutrients.duplicated().sum()    # number of duplicates
@@ -716,12 +1714,125 @@ max_foods["food"] = max_foods["food"].str[:50]
 
 max_foods.loc["Amino Acids"]["food"]
 
+# Grouped order statistics
+
+# quantile(0.5) sorts inside every group and apply(get_maximum) calls python once per group.
+# ex: sort all the rows once by (group code, value) and remember where each group starts. every
+# group is then a sorted slice, so quantiles, min/max and the rows holding them are just index math.
+# NaN values sort to the end of their group and are left out, like pandas does
+
+class GroupedOrderStats:
+    def __init__(self, df, keys, column):
+        codes = group_codes(df, keys, sort=True)
+        values = df[column].to_numpy(dtype="float64")
+        self.order = np.lexsort((values, codes))   # stable, so ties keep row order
+        self.values = values[self.order]
+        self.sizes = np.bincount(codes)
+        self.starts = np.r_[0, np.cumsum(self.sizes)[:-1]]
+        self.counts = np.bincount(codes[~np.isnan(values)], minlength=len(self.sizes))
+        first_rows = df.iloc[self.order[self.starts]]
+        if isinstance(keys, str):
+            self.groups = pd.Index(first_rows[keys])
+        else:
+            self.groups = pd.MultiIndex.from_frame(first_rows[keys])
+        self.row_labels = df.index
+
+    # linear interpolation between the two closest ranks, same as pandas' default
+    def quantile(self, q=0.5):
+        qs = np.atleast_1d(q)
+        pos = (self.counts[:, None] - 1) * qs[None, :]
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        v_lo = self.values[self.starts[:, None] + lo]
+        v_hi = self.values[self.starts[:, None] + hi]
+        result = np.where(self.counts[:, None] > 0, v_lo + (v_hi - v_lo) * (pos - lo), np.nan)
+        if np.ndim(q) == 0:
+            return pd.Series(result[:, 0], index=self.groups)
+        return pd.DataFrame(result, index=self.groups, columns=qs)
+
+    def min(self):
+        return pd.Series(np.where(self.counts > 0, self.values[self.starts], np.nan), index=self.groups)
+
+    def max(self):
+        return pd.Series(np.where(self.counts > 0, self.values[self.starts + self.counts - 1], np.nan), index=self.groups)
+
+    # row labels of the min/max in each group (first one if tied, like idxmin/idxmax)
+
+    def idxmin(self):
+        has = self.counts > 0
+        return pd.Series(self.row_labels[self.order[self.starts[has]]], index=self.groups[has])
+
+    def idxmax(self):
+        has = self.counts > 0
+        group_max = np.repeat(self.max().to_numpy(), self.sizes)
+        hits = np.flatnonzero(self.values == group_max)
+        group_of_hit = np.repeat(np.arange(len(self.sizes)), self.sizes)[hits]
+        _, first = np.unique(group_of_hit, return_index=True)   # earliest row among the tied maxes
+        return pd.Series(self.row_labels[self.order[hits[first]]], index=self.groups[has])
+
+value_stats = GroupedOrderStats(ndata, ["nutrient", "fgroup"], "value")
+
+result = value_stats.quantile(0.5)      # same as the groupby quantile
+
+value_stats.quantile([0.1, 0.5, 0.9]).loc["Zinc, Zn"]   # any set of quantiles from the same sort
+
+max_rows = GroupedOrderStats(ndata, ["nutgroup", "nutrient"], "value").idxmax()
+
+max_foods = ndata.loc[max_rows, ["value", "food"]].set_axis(max_rows.index)     # same as apply(get_maximum)
+
+max_foods["food"] = max_foods["food"].str[:50]
+
+max_foods.loc["Amino Acids"]["food"]
+
 # 13.5 2012 Federal Election Commission Database
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
 
 fec = pd.read_csv("../book files/datasets/fec/P00000001-ALL.csv", low_memory=False)
 
+# read_csv w/ low_memory=False parses the whole file in one go and every string col is object.
+# ex: a declared schema (categoricals for the repetitive string cols, float32 amounts, a real date)
+# and read the file in chunks, dropping the refunds (amount <= 0) as each chunk comes in.
+# each chunk gets its own categories, so they are unioned before the final concat, otherwise
+# concat falls back to object. w/ report_memory=True, tracemalloc measures the peak memory of the
+# load (what numpy/pandas allocate; the C parser's own small buffers aren't counted) and it ends up
+# in fec.attrs["peak_memory"]. tracing slows the load down, so it's off by default
+
+import tracemalloc
+from pandas.api.types import union_categoricals
+
+fec_schema = {"cand_nm": "category", "contbr_st": "category",
+              "contbr_occupation": "category", "contbr_employer": "category",
+              "contb_receipt_amt": np.float32}
+
+def read_fec(path, schema=fec_schema, chunksize=250_000, date_format="%d-%b-%y", report_memory=False):
+    started = report_memory and not tracemalloc.is_tracing()   # leave someone else's tracing running
+    if started:
+        tracemalloc.start()
+    try:
+        if report_memory:
+            baseline = tracemalloc.get_traced_memory()[0]     # what was already allocated before the load
+            tracemalloc.reset_peak()
+        pieces = []
+        for chunk in pd.read_csv(path, dtype=schema, chunksize=chunksize):
+            chunk = chunk[chunk["contb_receipt_amt"] > 0]
+            pieces.append(chunk.assign(contb_receipt_dt=pd.to_datetime(chunk["contb_receipt_dt"], format=date_format)))
+        cat_dtypes = {col: pd.CategoricalDtype(union_categoricals([p[col] for p in pieces]).categories)
+                      for col, dtype in schema.items() if dtype == "category"}
+        fec = pd.concat([p.astype(cat_dtypes) for p in pieces], ignore_index=True)
+        if report_memory:
+            fec.attrs["peak_memory"] = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        if started:
+            tracemalloc.stop()
+    return fec
+
+fec = read_fec("../book files/datasets/fec/P00000001-ALL.csv", report_memory=True)
+
+fec.attrs["peak_memory"] / 2**20   # peak MB while loading
+
+fec.memory_usage(deep=True).sum() / 2**20     # MB for the loaded table
+
 fec.info()
 
 # a sample record looks like this
@@ -757,8 +1868,24 @@ fec["cand_nm"][123456:123461]
 
 fec["cand_nm"][123456:123461].map(parties)  # interest
 
+# Remapping the categories instead of the rows
+
+# a per-row map(parties) (and map(get_occ), map(get_emp) below) does a lookup for each of ~1M rows,
+# but there are only a few thousand distinct values. ex: apply the dict or fn to the categories only,
+# then point the row codes at the new values. categories that end up w/ the same value get merged
+# ("C.E.O." and "CEO" become one "CEO" category). a dict works like Series.map (no match -> NaN),
+# so below pass get_occ/get_emp to keep the unmatched values as is
+
+def remap_categories(values, mapper):
+    cat = values.astype("category").array   # no copy if it's already categorical
+    new_values = pd.Index(cat.categories).map(mapper)
+    new_codes, new_categories = pd.factorize(new_values)     # merges repeats, NaN -> -1
+    lookup = np.append(new_codes, -1)       # so code -1 (missing) stays missing
+    return pd.Series(pd.Categorical.from_codes(lookup[cat.codes], new_categories),
+                     index=values.index, name=values.name)
+
 # add it as a column
-fec["party"] = fec["cand_nm"].map(parties)
+fec["party"] = remap_categories(fec["cand_nm"], parties)
 
 fec["party"].value_counts()
 
@@ -793,7 +1920,7 @@ def get_occ(x):
     # if no mapping provided, return x
     return occ_mapping.get(x, x)
 
-fec["contbr_occupation"] = fec["contbr_employer"].map(get_occ)
+fec["contbr_occupation"] = remap_categories(fec["contbr_occupation"], get_occ)
 
 # do the same thing for employers
 
@@ -808,7 +1935,9 @@ def get_emp(x):
     # if no mapping provided, return x
     return emp_mapping.get(x, x)
 
-fec["contbr_employer"] = fec["contbr_employer"].map(get_emp)
+fec["contbr_employer"] = remap_categories(fec["contbr_employer"], get_emp)
+
+fec["contbr_occupation"].cat.categories.size    # fewer categories after the merge
 
 # now use pivot_table to agg the data by party and occupation. 
 # then filter down to the subset that donated => $2 million overall
@@ -838,6 +1967,22 @@ grouped.apply(get_top_amounts, "contbr_occupation", n=7)
 
 grouped.apply(get_top_amounts, "contbr_employer", n=10)
 
+# ex: the same thing w/o a python callback per candidate. sum once over the (candidate, occupation)
+# pairs, then top_n_by_group (from the baby names section) picks the n biggest totals per candidate
+# from one sort. the top(df, n=5) helper from ch 10 is top_n_by_group(tips, "smoker", "tip_pct", 5)
+
+def top_totals_by_group(df, outer, inner, column, n, ascending=False, keep="first"):
+    outer = [outer] if isinstance(outer, str) else list(outer)
+    totals = df.groupby(outer + [inner], observed=True)[column].sum().reset_index()
+    top = top_n_by_group(totals, outer[0] if len(outer) == 1 else outer, column, n, ascending, keep)
+    return top.set_index(outer + [inner])[column]
+
+top_totals_by_group(fec_mrbo, "cand_nm", "contbr_occupation", "contb_receipt_amt", 7)    # same as the apply
+
+top_totals_by_group(fec_mrbo, "cand_nm", "contbr_employer", "contb_receipt_amt", 10)
+
+top_totals_by_group(fec_mrbo, "cand_nm", "contbr_employer", "contb_receipt_amt", {"Obama, Barack": 10, "Romney, Mitt": 5})
+
 # Bucketing Donation Amounts
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -868,6 +2013,70 @@ normed_sums
 
 normed_sums[:-2].plot(kind="barh")
 
+# Streaming donation histograms
+
+# pd.cut builds an interval label for every row and then we need a MultiIndex groupby + unstack.
+# ex: find each amount's bucket w/ searchsorted, and count/sum per (group key, bucket) w/ one
+# bincount on key_code * n_buckets + bucket (a 2-D histogram flattened to 1-D).
+# the counts keep adding up over chunks, so the file never has to be loaded whole
+
+# same buckets as pd.cut(amounts, bins): (bins[i], bins[i + 1]] -> i, anything outside -> -1
+
+def amount_bucket(amounts, bins):
+    amounts = np.asarray(amounts, dtype="float64")
+    codes = np.searchsorted(bins, amounts, side="left") - 1
+    codes[~((amounts > bins[0]) & (amounts <= bins[-1]))] = -1
+    return codes
+
+class GroupedHistogram:
+    def __init__(self, bins):
+        self.bins = np.asarray(bins)
+        self.keys = pd.Index([], dtype=object)      # grows like the name dictionary
+        self.counts = np.zeros((0, len(self.bins) - 1), dtype=np.int64)
+        self.sums = np.zeros((0, len(self.bins) - 1))
+
+    def add(self, keys, amounts):
+        codes, self.keys = encode_names(np.asarray(keys, dtype=object), self.keys)
+        buckets = amount_bucket(amounts, self.bins)
+        ok = buckets >= 0
+        shape = (len(self.keys), len(self.bins) - 1)
+        cell = codes[ok] * shape[1] + buckets[ok]
+        weights = np.asarray(amounts, dtype="float64")[ok]
+        new_rows = shape[0] - len(self.counts)      # keys seen for the first time
+        self.counts = np.vstack([self.counts, np.zeros((new_rows, shape[1]), dtype=np.int64)])
+        self.sums = np.vstack([self.sums, np.zeros((new_rows, shape[1]))])
+        self.counts += np.bincount(cell, minlength=shape[0] * shape[1]).reshape(shape)
+        self.sums += np.bincount(cell, weights=weights, minlength=shape[0] * shape[1]).reshape(shape)
+        return self
+
+    # buckets down, keys across, like grouped.size().unstack(level=0). NaN keys are left out
+
+    def _table(self, values):
+        keep = self.keys.notna()
+        return pd.DataFrame(values[keep].T, index=pd.IntervalIndex.from_breaks(self.bins),
+                            columns=self.keys[keep])
+
+    def count_table(self):
+        return self._table(self.counts)
+
+    def sum_table(self):
+        return self._table(self.sums)
+
+donation_hist = GroupedHistogram(bins)
+
+for chunk in pd.read_csv("../book files/datasets/fec/P00000001-ALL.csv", chunksize=250_000,
+                         usecols=["cand_nm", "contb_receipt_amt"]):
+    chunk = chunk[chunk["cand_nm"].isin(["Obama, Barack", "Romney, Mitt"])]
+    donation_hist.add(chunk["cand_nm"], chunk["contb_receipt_amt"])
+
+donation_hist.count_table()     # same as grouped.size().unstack(level=0)
+
+bucket_sums = donation_hist.sum_table()
+
+normed_sums = bucket_sums.div(bucket_sums.sum(axis="columns"), axis="index")
+
+normed_sums
+
 # Donation Statistics by State
 
 # McKinney, Wes. Python for Data Analysis . O'Reilly Media. Kindle Edition. 
@@ -889,3 +2098,98 @@ percent = totals.div(totals.sum(axis="columns"), axis="index")
 
 percent.head(10)
 
+# Contribution cube
+
+# by_occupation, get_top_amounts, the pd.cut buckets and the state totals each rescan every contribution.
+# ex: aggregate once into a cube of (cand_nm, party, contbr_st, occupation, employer, amount bucket)
+# cells holding the sum and count. every view above is then a rollup (groupby-sum) of the much smaller
+# cube. each dim is stored as int codes w/ a label list that only ever grows (same trick as the
+# name dictionary), so new filings can be added later w/o touching the old cells
+
+class ContributionCube:
+    def __init__(self, bins, dims=("cand_nm", "party", "contbr_st", "contbr_occupation", "contbr_employer")):
+        self.bins = np.asarray(bins)
+        self.dims = list(dims)
+        self.labels = {dim: pd.Index([], dtype=object) for dim in self.dims}
+        self.cells = None
+
+    def add(self, fec, amount="contb_receipt_amt"):
+        part = pd.DataFrame({"bucket": amount_bucket(fec[amount], self.bins),
+                             "sum": fec[amount].to_numpy(dtype="float64"), "count": 1})
+        for dim in self.dims:
+            part[dim], self.labels[dim] = encode_names(np.asarray(fec[dim], dtype=object), self.labels[dim])
+        if self.cells is not None:
+            part = pd.concat([self.cells, part], ignore_index=True)
+        self.cells = part.groupby(self.dims + ["bucket"], as_index=False, sort=False)[["sum", "count"]].sum()
+        return self
+
+    def bucket_labels(self):
+        return pd.IntervalIndex.from_breaks(self.bins)
+
+    # sum + count by any subset of dims ("bucket" included), optionally only for some labels of a dim,
+    # e.g. filters={"cand_nm": ["Obama, Barack", "Romney, Mitt"]}. missing (NaN) labels are dropped
+    # like groupby does
+
+    def rollup(self, by, filters=None):
+        by = [by] if isinstance(by, str) else list(by)
+        cells = self.cells[self.cells["bucket"] >= 0] if "bucket" in by else self.cells
+        for dim, wanted in (filters or {}).items():
+            cells = cells[cells[dim].isin(self.labels[dim].get_indexer(wanted))]
+        out = cells.groupby(by)[["sum", "count"]].sum()
+        levels = [self.bucket_labels() if dim == "bucket" else self.labels[dim] for dim in by]
+        codes = [out.index.get_level_values(dim).to_numpy() for dim in by]
+        out.index = pd.MultiIndex.from_arrays([level[c] for level, c in zip(levels, codes)], names=by)
+        out = out[out.index.to_frame().notna().all(axis=1).to_numpy()]
+        if "bucket" in by:      # every bucket shows up, empty ones w/ 0 (like the book's pd.cut + groupby)
+            levels = [self.bucket_labels() if dim == "bucket" else out.index.unique(dim) for dim in by]
+            out = out.reindex(pd.MultiIndex.from_product(levels, names=by), fill_value=0)
+        if len(by) == 1:
+            out.index = out.index.get_level_values(0)
+        return out
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        for col in self.cells:
+            np.save(os.path.join(cache_dir, f"{col}.npy"), self.cells[col].to_numpy())
+        labels = {dim: [None if pd.isna(x) else x for x in self.labels[dim]] for dim in self.dims}
+        with open(os.path.join(cache_dir, "labels.json"), "w") as f:
+            json.dump({"bins": self.bins.tolist(), "dims": self.dims, "labels": labels}, f)
+
+    @classmethod
+    def load(cls, cache_dir):
+        with open(os.path.join(cache_dir, "labels.json")) as f:
+            meta = json.load(f)
+        cube = cls(meta["bins"], meta["dims"])
+        cube.labels = {dim: pd.Index([np.nan if x is None else x for x in values], dtype=object)
+                       for dim, values in meta["labels"].items()}
+        columns = cube.dims + ["bucket", "sum", "count"]
+        cube.cells = pd.DataFrame({col: np.load(os.path.join(cache_dir, f"{col}.npy")) for col in columns})
+        return cube
+
+fec_cube = ContributionCube(bins).add(fec)
+
+if __name__ == "__main__":
+    fec_cube.save("../book files/datasets/fec/contribution_cube")
+
+fec_cube.cells.shape    # one row per distinct cell, usually a lot fewer than fec
+
+# new filings: fec_cube.add(new_rows), only the new rows get aggregated
+
+# all of the views from above, now from the cube
+
+by_occupation = fec_cube.rollup(["contbr_occupation", "party"])["sum"].unstack("party")
+
+over_2mm = by_occupation[by_occupation.sum(axis="columns") > 2000000]
+
+mrbo = {"cand_nm": ["Obama, Barack", "Romney, Mitt"]}
+
+top_n_by_group(fec_cube.rollup(["cand_nm", "contbr_occupation"], mrbo).reset_index(), "cand_nm", "sum", 7)
+
+bucket_sums = fec_cube.rollup(["bucket", "cand_nm"], mrbo)["sum"].unstack("cand_nm")
+
+normed_sums = bucket_sums.div(bucket_sums.sum(axis="columns"), axis="index")
+
+totals = fec_cube.rollup(["contbr_st", "cand_nm"], mrbo)["sum"].unstack("cand_nm").fillna(0)
+
+totals = totals[totals.sum(axis="columns") > 100000]
+